@@ -57,6 +57,12 @@ class BoxTextList:
     def add(self, box, text, n=1) -> None:
         self.box_texts.append(BoxText(box, text, n))
 
+    def extend(self, items) -> None:
+        """Add each (box, text) of `items`"""
+        append = self.box_texts.append
+        for box, text in items:
+            append(BoxText(box, text))
+
     def sort(self) -> None:
         """Sort boxes by lexicographic order"""
         self.box_texts.sort(key=lambda box_text: box_text.box)
@@ -116,8 +122,9 @@ class BoxTextList:
     def _get_image(self, image_in):
         plt.rcParams['font.family'] = 'Noto Serif SC'  # 指定中文字体
         img = mtgscan.utils.load_url_or_file_or_base64(image_in)
+        width, height = img.size
         fig, ax = plt.subplots(
-            figsize=(img.shape[1] // 64, img.shape[0] // 64))
+            figsize=(width // 64, height // 64))
         ax.imshow(img, aspect='equal')
         for box, text, n in self.box_texts:
             P = (box[0], box[1])
@@ -1,17 +1,162 @@
+import asyncio
+from collections import OrderedDict
+from functools import partial
+from io import BytesIO
 import logging
 import os
-import time
+import threading
 
-import requests
-from mtgscan.box_text import BoxTextList
-from mtgscan.utils import is_url
+import httpx
+from PIL import Image
+try:
+    from xxhash import xxh3_128 as _hasher
+except ImportError:  # xxhash is optional, only used to key the cache
+    from hashlib import blake2b as _hasher
+from mtgscan.box_text import BoxText, BoxTextList
+from mtgscan.utils import _open_image, is_url, json_loads
 from .ocr import OCR
 import base64
 
+# HTTP status codes worth retrying: throttling and server-side errors
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+# size of the chunks in which image files are uploaded
+CHUNK_SIZE = 64 * 1024
+
+
+async def _iter_file(path, chunk_size=CHUNK_SIZE):
+    # read in the executor, so that reading the file doesn't block the other images of a batch
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, path, "rb")
+    with f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _hash_file(path, chunk_size=CHUNK_SIZE) -> bytes:
+    h = _hasher()
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, chunk_size), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _hash_bytes(data: bytes) -> bytes:
+    return _hasher(data).digest()
+
+
+def _downscale(fp, max_dim: int, quality: int):
+    """Shrink the image in `fp` so that its width and height are at most `max_dim`
+
+    Returns
+    -------
+    (bytes, float) or None
+        The image encoded as JPEG and the factor by which it was shrunk,
+        or None if the image is already small enough or can't be decoded by PIL
+        (e.g. PDF, truncated file): it is then sent as is and Azure handles it
+    """
+    try:
+        with Image.open(fp) as img:  # only reads the header
+            width, height = img.size
+            exif = img.info.get("exif", b"")  # keeps the orientation of photos
+        if max(width, height) <= max_dim:
+            return None
+        img = _open_image(fp, max_dim, mode="RGB")  # JPEG has no alpha channel nor palette
+    except (OSError, Image.DecompressionBombError) as e:
+        logging.info(f"Image not downscaled: {e!r}")
+        return None
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=quality, optimize=True, exif=exif)
+    return buffer.getvalue(), width / img.width
+
+
+def _error_message(r: httpx.Response) -> str:
+    """Message of an Azure error response, whose body may not be JSON (e.g. from a gateway)"""
+    try:
+        return json_loads(r.content).get("error", {}).get("message", "Unknown error")
+    except (ValueError, AttributeError):
+        return f"HTTP {r.status_code}: {r.text[:200]}"
+
+
+def _copy_box_texts(box_texts: BoxTextList) -> BoxTextList:
+    """Copy of `box_texts` sharing nothing with it, since MagicRecognition sorts and edits box_texts in place"""
+    return BoxTextList([BoxText(list(box), text, n) for box, text, n in box_texts])
+
+
+def _parse_read_results(analysis: dict, scale=1) -> BoxTextList:
+    """Texts and boxes of a successful Read analysis
+
+    Box coordinates are multiplied by `scale`, to map them back to the original image if it was downscaled.
+    """
+    lines = [line
+             for page in analysis["analyzeResult"]["readResults"]
+             for line in page.get("lines", ())
+             if "boundingBox" in line and "text" in line]
+    box_texts = BoxTextList()
+    if scale == 1:
+        box_texts.extend((line["boundingBox"], line["text"]) for line in lines)
+    else:
+        box_texts.extend(([round(c * scale) for c in line["boundingBox"]], line["text"]) for line in lines)
+    return box_texts
+
 
 class Azure(OCR):
 
-    def __init__(self):
+    def __init__(self, max_retries=3, backoff_base=1.0, max_backoff=32.0,
+                 poll_timeout=120.0, poll_delay=0.2, poll_factor=1.5, max_poll_delay=2.0,
+                 pool_size=32, cache_size=0, max_dim=2000, jpeg_quality=85, max_concurrency=8, rps=None):
+        """
+        Parameters
+        ----------
+        max_retries : int, optional
+            Number of retries on a transient failure (timeout, connection error, 429 or 5xx), by default 3
+        backoff_base : float, optional
+            Seconds to wait before the first retry, doubled at each new retry, by default 1.0
+        max_backoff : float, optional
+            Maximum number of seconds to wait between two retries, by default 32.0
+        poll_timeout : float, optional
+            Maximum number of seconds to wait for the result of an analysis, by default 120.0
+        poll_delay : float, optional
+            Seconds to wait before polling the result for the first time, by default 0.2
+        poll_factor : float, optional
+            Factor applied to the polling delay after each unsuccessful poll, by default 1.5
+        max_poll_delay : float, optional
+            Maximum number of seconds between two polls, by default 2.0
+        pool_size : int, optional
+            Maximum number of simultaneous connections to Azure kept by a client, by default 32
+        cache_size : int, optional
+            Number of OCR results kept in memory, keyed by image URL or content, by default 0 (no cache)
+        max_dim : int, optional
+            Files and base64 images larger than `max_dim` pixels (width or height) are downscaled
+            and sent as JPEG, by default 2000. None to always send images unchanged.
+            Boxes are given in the coordinates of the original image in any case.
+        jpeg_quality : int, optional
+            Quality of the JPEG sent for downscaled images, by default 85
+        max_concurrency : int, optional
+            Maximum number of images of a batch being processed by Azure at the same time, by default 8
+        rps : float, optional
+            Maximum number of images sent to Azure per second by batches, across calls, by default unlimited
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.poll_timeout = poll_timeout
+        self.poll_delay = poll_delay
+        self.poll_factor = poll_factor
+        self.max_poll_delay = max_poll_delay
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # LRU of BoxTextList, keyed by URL or content hash
+        self.max_dim = max_dim
+        self.jpeg_quality = jpeg_quality
+        self._duration_ema = None  # moving average of analysis durations, in seconds
+        # event loop and client of the synchronous calls of each thread, see _run_sync
+        self._local = threading.local()
+        self._sync_clients = []  # (loop, client) of every thread, released by close
+        self._lock = threading.Lock()
+        self._batch = AzureBatchClient(self, max_concurrency=max_concurrency, rps=rps)
         try:
             self.subscription_key = os.environ['AZURE_VISION_KEY']
             self.text_recognition_url = os.environ['AZURE_VISION_ENDPOINT'] + \
@@ -25,40 +170,313 @@ class Azure(OCR):
     def __str__(self):
         return "Azure"
 
-    def image_to_box_texts(self, image: str, is_base64=False) -> BoxTextList:
-        headers = {'Ocp-Apim-Subscription-Key': self.subscription_key}
-        json, data = None, None
-        if is_url(image):
-            logging.info(f"Reading image from URL: {image}")
-            json = {'url': image}
-        else:
-            headers['Content-Type'] = 'application/octet-stream'
-            if is_base64:
+    def image_to_box_texts(self, image: str = None, is_base64=False, *, url=None, path=None, data=None) -> BoxTextList:
+        """Synchronous wrapper around `image_to_box_texts_async`
+
+        Must not be called from a running event loop: await
+        `image_to_box_texts_async` instead.
+        """
+        return self._run_sync(lambda client: self.image_to_box_texts_async(
+            image, is_base64, client, url=url, path=path, data=data))
+
+    def batch_image_to_box_texts(self, images, is_base64=False) -> list:
+        """Synchronous wrapper around `batch_image_to_box_texts_async`"""
+        return self._batch.batch_image_to_box_texts(images, is_base64)
+
+    def _run_sync(self, coro_fn):
+        """Run `coro_fn(client)` on the event loop kept for the synchronous calls of the current thread
+
+        Each thread gets its own loop and HTTP client, which live until `close`, so that
+        successive synchronous calls reuse the same connections to Azure.
+        """
+        local = self._local
+        if getattr(local, "loop", None) is None:
+            local.loop = asyncio.new_event_loop()
+            local.client = self._new_client()
+            with self._lock:
+                self._sync_clients.append((local.loop, local.client))
+        return local.loop.run_until_complete(coro_fn(local.client))
+
+    def close(self) -> None:
+        """Close the connections kept by synchronous calls, in every thread
+
+        Must not be called while synchronous calls are running.
+        """
+        with self._lock:
+            sync_clients, self._sync_clients = self._sync_clients, []
+            self._local = threading.local()
+        for loop, client in sync_clients:
+            loop.run_until_complete(client.aclose())
+            loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def batch_image_to_box_texts_async(self, images, is_base64=False, client=None) -> list:
+        """Apply OCR on several images concurrently
+
+        The Read v3.2 API analyzes a single image per request: images are sent as concurrent
+        requests, bounded by the `max_concurrency` and `rps` of this instance, see `AzureBatchClient`.
+
+        Parameters
+        ----------
+        images : list of str
+            URLs, paths or base64 encoded images
+        is_base64 : bool, optional
+            Whether the images are base64 encoded, by default False
+        client : httpx.AsyncClient, optional
+            Client to send the requests with, to reuse its connections across calls.
+            By default, a new client is opened for this batch.
+
+        Returns
+        -------
+        list of BoxTextList
+            Texts and boxes recognized by the OCR, in the same order as `images`
+        """
+        return await self._batch.batch_image_to_box_texts_async(images, is_base64, client)
+
+    def _new_client(self) -> httpx.AsyncClient:
+        """HTTP/2 client: requests sent through it share its connections, and are multiplexed on them"""
+        return httpx.AsyncClient(http2=True, timeout=httpx.Timeout(30.0),
+                                 limits=httpx.Limits(max_connections=self.pool_size))
+
+    def _cache_get(self, key):
+        if key not in self._cache:
+            return None
+        self._cache.move_to_end(key)
+        return _copy_box_texts(self._cache[key])
+
+    def _cache_put(self, key, box_texts: BoxTextList) -> None:
+        self._cache[key] = _copy_box_texts(box_texts)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, self.backoff_base * 2**attempt)
+
+    async def _request_with_retry(self, client, method, url, body=None, **kwargs) -> httpx.Response:
+        """Send a request, retrying on transient failures with exponential backoff
+
+        The `Retry-After` header sent by Azure, if any, takes precedence over the backoff.
+        `body`, if given, is a function returning the data to send: it is called again at
+        each attempt, since a streamed body can only be consumed once.
+        """
+        for attempt in range(self.max_retries + 1):
+            if body is not None:
+                kwargs["content"] = body()
+            try:
+                r = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning(f"{method} {url} failed ({e!r}), retrying in {delay}s")
+            else:
+                if r.status_code not in TRANSIENT_STATUS or attempt == self.max_retries:
+                    return r
+                try:
+                    delay = float(r.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    delay = self._backoff(attempt)
+                logging.warning(f"{method} {url} returned {r.status_code}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+    async def _poll_analysis(self, client, operation_url, headers) -> dict:
+        """Poll `operation_url` until the analysis is over
+
+        The delay between two polls grows geometrically from `poll_delay` to `max_poll_delay`.
+        The first delay is adjusted to half the average duration of previous analyses,
+        up to `max_poll_delay`, so that a single slow analysis doesn't delay the next ones.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + self.poll_timeout
+        delay = self.poll_delay
+        if self._duration_ema is not None:
+            delay = max(delay, min(self._duration_ema / 2, self.max_poll_delay))
+        while loop.time() < deadline:
+            await asyncio.sleep(min(delay, max(0, deadline - loop.time())))
+            r = await self._request_with_retry(client, "GET", operation_url, headers=headers)
+            if r.status_code != 200:  # e.g. 401, or 404 once the operation has expired
+                raise Exception(f"Azure API request failed: {_error_message(r)}")
+            analysis = json_loads(r.content)
+            if "analyzeResult" in analysis:
+                duration = loop.time() - start
+                self._duration_ema = duration if self._duration_ema is None else \
+                    0.8 * self._duration_ema + 0.2 * duration
+                return analysis
+            if "status" in analysis and analysis['status'] == 'failed':
+                raise Exception(f"Azure analysis failed: {analysis}")
+            delay = min(delay * self.poll_factor, self.max_poll_delay)
+        raise Exception(f"Azure analysis not finished after {self.poll_timeout}s")
+
+    async def image_to_box_texts_async(self, image: str = None, is_base64=False, client=None, *,
+                                       url=None, path=None, data=None) -> BoxTextList:
+        """Apply OCR on an image containing Magic cards
+
+        The kind of `image` is guessed. Callers knowing it can instead give `url`, `path`
+        or `data`, which skips the guess. Exactly one of these four arguments must be given.
+
+        Parameters
+        ----------
+        image : str
+            URL or path to an image, or base64 encoded image
+        is_base64 : bool, optional
+            Whether `image` is base64 encoded, by default False
+        client : httpx.AsyncClient, optional
+            Client to send the requests with, to reuse its connections across calls.
+            By default, a new client is opened for this image.
+        url : str, optional
+            URL of an image
+        path : str, optional
+            Path to an image
+        data : bytes, optional
+            Content of an image file
+
+        Returns
+        -------
+        BoxTextList
+            Texts and boxes recognized by the OCR
+        """
+        if sum(source is not None for source in (image, url, path, data)) != 1:
+            raise TypeError("Exactly one of image, url, path or data must be given")
+        if client is None:
+            async with self._new_client() as client:
+                return await self.image_to_box_texts_async(image, is_base64, client, url=url, path=path, data=data)
+        if image is not None:
+            if is_url(image):
+                url = image
+            elif is_base64:
                 logging.info(f"Reading image as base64")
                 data = base64.b64decode(image)
             else:
-                logging.info(f"Reading image from file: {image}")
-                with open(image, "rb") as f:
-                    data = f.read()
+                path = image
+        if url is not None:
+            return await self._box_texts_from_url(client, url)
+        if path is not None:
+            return await self._box_texts_from_file(client, path)
+        return await self._box_texts_from_bytes(client, data)
+
+    async def _box_texts_from_url(self, client, url: str) -> BoxTextList:
+        logging.info(f"Reading image from URL: {url}")
+        return await self._analyze(client, url, json={'url': url})
+
+    async def _box_texts_from_file(self, client, path) -> BoxTextList:
+        logging.info(f"Reading image from file: {path}")
+        key = None
+        if self.cache_size:
+            # in the executor, so that reading the file doesn't block the other images of a batch
+            key = await asyncio.get_running_loop().run_in_executor(None, _hash_file, path)
+        return await self._analyze(client, key, path=path)
+
+    async def _box_texts_from_bytes(self, client, data: bytes) -> BoxTextList:
+        key = None
+        if self.cache_size:
+            # in the executor, so that hashing a large image doesn't block the other images of a batch
+            key = await asyncio.get_running_loop().run_in_executor(None, _hash_bytes, data)
+        return await self._analyze(client, key, data=data)
+
+    async def _analyze(self, client, key, json=None, data=None, path=None) -> BoxTextList:
+        """Send an image to Azure and wait for its texts
+
+        The image is either a URL (`json`), bytes (`data`) or a file (`path`).
+        `key` identifies the image in the cache.
+        """
+        if self.cache_size:
+            box_texts = self._cache_get(key)
+            if box_texts is not None:
+                logging.info("Image found in cache")
+                return box_texts
+        headers = {'Ocp-Apim-Subscription-Key': self.subscription_key}
+        body, scale = None, 1
+        if json is None:
+            headers['Content-Type'] = 'application/octet-stream'
+            if self.max_dim:
+                downscaled = await asyncio.get_running_loop().run_in_executor(
+                    None, _downscale, path if data is None else BytesIO(data), self.max_dim, self.jpeg_quality)
+                if downscaled is not None:
+                    data, scale = downscaled
+                    logging.info(f"Image downscaled by {scale:.2f}")
+            if data is None:
+                # streamed rather than read at once; the explicit length avoids chunked encoding
+                headers['Content-Length'] = str(os.path.getsize(path))
+                body = partial(_iter_file, path)
         logging.info(f"Sending image to Azure")
-        response = requests.post(
-            self.text_recognition_url, headers=headers, json=json, data=data)
-        # response.raise_for_status()
+        r = await self._request_with_retry(
+            client, "POST", self.text_recognition_url, body=body, headers=headers, json=json, content=data)
         # https://westcentralus.dev.cognitive.microsoft.com/docs/services/computer-vision-v3-1-ga/operations/5d986960601faab4bf452005
-        if response.status_code != 202:
-            error_message = response.json().get("error", {}).get("message", "Unknown error")
-            raise Exception(f"Azure API request failed: {error_message}")
-        poll = True
-        while poll:
-            response_final = requests.get(
-                response.headers["Operation-Location"], headers=headers)
-            analysis = response_final.json()
-            time.sleep(1)
-            if "analyzeResult" in analysis:
-                poll = False
-            if "status" in analysis and analysis['status'] == 'failed':
-                poll = False
-        box_texts = BoxTextList()
-        for line in analysis["analyzeResult"]["readResults"][0]["lines"]:
-            box_texts.add(line["boundingBox"], line["text"])
+        if r.status_code != 202:
+            raise Exception(f"Azure API request failed: {_error_message(r)}")
+        operation_url = r.headers["Operation-Location"]
+        analysis = await self._poll_analysis(
+            client, operation_url, {'Ocp-Apim-Subscription-Key': self.subscription_key})
+        box_texts = _parse_read_results(analysis, scale)
+        if self.cache_size:
+            self._cache_put(key, box_texts)
         return box_texts
+
+
+class RateLimiter:
+    """Space out calls to `wait` by at least 1/rps seconds"""
+
+    def __init__(self, rps: float):
+        self.min_interval = 1 / rps
+        self._next = 0.0  # earliest time (in event loop clock) of the next call
+
+    async def wait(self) -> None:
+        now = asyncio.get_running_loop().time()
+        t = max(now, self._next)
+        self._next = t + self.min_interval
+        if t > now:
+            await asyncio.sleep(t - now)
+
+
+class AzureBatchClient:
+    """Send many images to Azure, bounding both concurrency and request rate
+
+    Azure Read quotas are expressed in requests per second: going over them
+    results in 429 errors, which are retried but waste time.
+    Each `Azure` keeps one, set up with its `max_concurrency` and `rps`, behind its batch methods.
+    """
+
+    def __init__(self, azure: Azure = None, max_concurrency=8, rps=None):
+        """
+        Parameters
+        ----------
+        azure : Azure, optional
+            OCR used to process each image, by default `Azure()`
+        max_concurrency : int, optional
+            Maximum number of images being processed by Azure at the same time, by default 8
+        rps : float, optional
+            Maximum number of images sent to Azure per second, by default unlimited
+        """
+        self.azure = Azure() if azure is None else azure
+        self.max_concurrency = max_concurrency
+        self.rps = rps
+        # shared by every batch, so that the rate holds across successive calls
+        self._limiter = RateLimiter(rps) if rps else None
+
+    def batch_image_to_box_texts(self, images, is_base64=False) -> list:
+        """Synchronous wrapper around `batch_image_to_box_texts_async`"""
+        return self.azure._run_sync(lambda client: self.batch_image_to_box_texts_async(images, is_base64, client))
+
+    async def batch_image_to_box_texts_async(self, images, is_base64=False, client=None) -> list:
+        """Apply OCR on several images, returning a BoxTextList per image (in the same order)
+
+        `client` (httpx.AsyncClient) is used to send the requests, by default a new client is opened for this batch.
+        """
+        if client is None:
+            async with self.azure._new_client() as client:
+                return await self.batch_image_to_box_texts_async(images, is_base64, client)
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(image, client):
+            async with sem:
+                if self._limiter is not None:
+                    await self._limiter.wait()
+                return await self.azure.image_to_box_texts_async(image, is_base64, client)
+
+        return await asyncio.gather(*[run(image, client) for image in images])
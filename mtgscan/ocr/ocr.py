@@ -16,3 +16,18 @@ class OCR:
             Texts and boxes recognized by the OCR
         """
         raise NotImplementedError()
+
+    def batch_image_to_box_texts(self, images) -> list:
+        """Apply OCR on several images
+
+        Parameters
+        ----------
+        images : list of str
+            URLs or paths to images
+
+        Returns
+        -------
+        list of BoxTextList
+            Texts and boxes recognized by the OCR, in the same order as `images`
+        """
+        return [self.image_to_box_texts(image) for image in images]
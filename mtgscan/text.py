@@ -9,16 +9,21 @@ from symspellpy import SymSpell, Verbosity, editdistance
 
 from .box_text import BoxTextList
 from .deck import Deck, Pile
+from .utils import json_loads
 
 # URL to download card list, if needed
 URL_ALL_CARDS = "https://mtgjson.com/api/v5/VintageAtomic.json"
 URL_KEYWORDS = "https://mtgjson.com/api/v5/Keywords.json"
 
+# characters which can't appear on a Magic card, see MagicRecognition._preprocess
+RE_NON_CARD_CHARS = re.compile(
+    r"[^\w\s\u4e00-\u9fa5\u3040-\u309F\u30A0-\u30FF\uAC00-\uD7AF\u0400-\u04FF\u0370-\u03FF]")
+
 
 def load_json(url):
     print(f"Loading {url}")
     r = requests.get(url)
-    return r.json()
+    return json_loads(r.content)
 
 
 class MagicRecognition:
@@ -79,7 +84,7 @@ class MagicRecognition:
                 res.extend(L)
             return res
 
-        keywords_json = json.load(Path(file_keywords).open())
+        keywords_json = json_loads(Path(file_keywords).read_bytes())
         keywords = concat_lists(keywords_json["data"].values())
         keywords.extend(["Display", "Land", "Search", "Profile"])
         self.sym_keywords = SymSpell(max_dictionary_edit_distance=3)
@@ -100,7 +105,7 @@ class MagicRecognition:
         \u0400-\u04FF: 匹配西里尔字母，用于许多斯拉夫语系国家的语言
         \u0370-\u03FF: 匹配希腊字母
         """
-        return re.sub("[^\w\s\u4e00-\u9fa5\u3040-\u309F\u30A0-\u30FF\uAC00-\uD7AF\u0400-\u04FF\u0370-\u03FF]", '', text).rstrip(' ')
+        return RE_NON_CARD_CHARS.sub('', text).rstrip(' ')
 
     def _preprocess_texts(self, box_texts: BoxTextList) -> None:
         """Apply `preprocess` on each text"""
@@ -7,30 +7,73 @@ import numpy as np
 import requests
 from PIL import Image
 import os
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, for faster parsing of large JSON
+    from json import loads as json_loads
+
+
+# settle most inputs without parsing them
+URL_PREFIXES = ('http://', 'https://', 'ftp://', 'ftps://', 'data:')
 
 
 def is_url(text: str) -> bool:
-    parsed = urlparse(str(text))
-    return len(parsed.scheme) > 1
+    s = str(text)
+    if s.startswith(URL_PREFIXES):
+        return True
+    if '://' not in s[:12]:  # paths and base64 images
+        return False
+    return len(urlparse(s).scheme) > 1
+
+
+def is_file(text: str) -> bool:
+    """Whether `text` is the path of an existing file
+
+    Long strings (e.g. base64 images) are rejected without a system call.
+    """
+    s = str(text)
+    return len(s) < 4096 and '\x00' not in s and os.path.isfile(s)
+
+
+def _open_image(fp, max_dim: int = None, mode: str = None) -> Image.Image:
+    img = Image.open(fp)
+    if max_dim is not None:
+        # lets libjpeg decode directly at a reduced scale (no-op for other formats)
+        img.draft("RGB", (max_dim, max_dim))
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)  # before resizing, since palette images are only resized with NEAREST
+    if max_dim is not None:
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    return img
 
 
-def load_url_or_file_or_base64(image: str) -> Image.Image:
+def load_url_or_file_or_base64(image: str, max_dim: int = None) -> Image.Image:
     """Load an image
 
     Parameters
     ----------
     image : str
         Url or path or base64 encoded image
+    max_dim : int, optional
+        If given, the image is downscaled so that its width and height are at most `max_dim`
 
     Returns
     -------
-    Numpy array representing the image
+    Image.Image
+        Loaded image, see `as_ndarray` to get its pixels
     """
     if is_url(image):
         response = requests.get(image)
         response.raise_for_status()
         image = BytesIO(response.content)
     # image 有可能是 base64 导致下面这段话报错 OSError: [Errno 36] File name too long:
-    elif not os.path.isfile(image):
+    elif not is_file(image):
         image = BytesIO(base64.b64decode(image))
-    return np.asarray(Image.open(image))
+    img = _open_image(image, max_dim)
+    img.load()  # decode now, instead of keeping the file open until the pixels are accessed
+    return img
+
+
+def as_ndarray(img: Image.Image) -> np.ndarray:
+    """Numpy array of the pixels of `img`"""
+    return np.asarray(img)
@@ -71,3 +71,4 @@ for sample in DIR_SAMPLES.iterdir():
 for ocr in ocr_all:
     err = errors[str(ocr)]
     print(f"{ocr} Error rate: {sum(err) / len(err):.2f}")
+    ocr.close()
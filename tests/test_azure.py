@@ -0,0 +1,333 @@
+"""Offline tests of the Azure OCR client: HTTP requests go to a mocked transport"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import logging
+import threading
+import time
+
+import httpx
+from PIL import Image
+import pytest
+
+from mtgscan.ocr.azure import Azure, RateLimiter, _parse_read_results
+
+URL_ANALYZE = "https://azure.test/vision/v3.2/read/analyze"
+URL_OPERATION = "https://azure.test/vision/v3.2/read/analyzeResults/1"
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv("AZURE_VISION_KEY", "key")
+    monkeypatch.setenv("AZURE_VISION_ENDPOINT", "https://azure.test")
+
+
+@pytest.fixture
+def azure(env):
+    return Azure(poll_delay=0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the delays of asyncio.sleep instead of waiting"""
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def mock_client(responses):
+    """Client answering each request with the next element of `responses`, recording the requests"""
+    requests = []
+    responses = iter(responses)
+
+    def handler(request):
+        requests.append(request)
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), requests
+
+
+def handle_analysis(request):
+    """Answer the requests of an analysis finding no text"""
+    if request.method == "POST":
+        return httpx.Response(202, headers={"Operation-Location": URL_OPERATION})
+    return httpx.Response(200, json={"status": "succeeded", "analyzeResult": {"readResults": [{"lines": []}]}})
+
+
+def request_with_retry(azure, responses):
+    async def run():
+        client, requests = mock_client(responses)
+        async with client:
+            r = await azure._request_with_retry(client, "POST", URL_ANALYZE)
+        return r, requests
+    return asyncio.run(run())
+
+
+def test_retry_until_accepted(azure, sleeps):
+    r, requests = request_with_retry(azure, [
+        httpx.Response(429, headers={"Retry-After": "7"}),
+        httpx.Response(503),
+        httpx.Response(202),
+    ])
+    assert r.status_code == 202
+    assert len(requests) == 3
+    assert sleeps == [7.0, 2.0]  # Retry-After, then backoff_base * 2**1
+
+
+def test_retry_on_connection_error(azure, sleeps):
+    r, requests = request_with_retry(azure, [httpx.ConnectError("refused"), httpx.Response(202)])
+    assert r.status_code == 202
+    assert len(requests) == 2
+    assert sleeps == [1.0]
+
+
+def test_retry_gives_up(azure, sleeps):
+    r, requests = request_with_retry(azure, [httpx.Response(503)] * 4)
+    assert r.status_code == 503
+    assert len(requests) == azure.max_retries + 1
+    assert sleeps == [1.0, 2.0, 4.0]
+
+
+def test_no_retry_on_client_error(azure, sleeps):
+    r, requests = request_with_retry(azure, [httpx.Response(400), httpx.Response(202)])
+    assert r.status_code == 400
+    assert len(requests) == 1
+    assert sleeps == []
+
+
+def test_analysis(azure, sleeps):
+    lines = [{"boundingBox": [1, 2, 3, 4, 5, 6, 7, 8], "text": "Black Lotus"}]
+
+    async def run():
+        client, requests = mock_client([
+            httpx.Response(202, headers={"Operation-Location": URL_OPERATION}),
+            httpx.Response(200, json={"status": "running"}),
+            httpx.Response(200, json={"status": "succeeded", "analyzeResult": {"readResults": [{"lines": lines}]}}),
+        ])
+        async with client:
+            box_texts = await azure.image_to_box_texts_async(url="https://img.test/deck.jpg", client=client)
+        return box_texts, requests
+
+    box_texts, requests = asyncio.run(run())
+    assert [(b.box, b.text) for b in box_texts] == [([1, 2, 3, 4, 5, 6, 7, 8], "Black Lotus")]
+    assert [r.method for r in requests] == ["POST", "GET", "GET"]
+
+
+def test_first_poll_delay_capped(azure, sleeps):
+    azure._duration_ema = 60.0  # after a slow analysis
+
+    async def run():
+        client, _ = mock_client([
+            httpx.Response(202, headers={"Operation-Location": URL_OPERATION}),
+            httpx.Response(200, json={"status": "succeeded", "analyzeResult": {"readResults": []}}),
+        ])
+        async with client:
+            await azure.image_to_box_texts_async(url="https://img.test/deck.jpg", client=client)
+
+    asyncio.run(run())
+    assert sleeps == [azure.max_poll_delay]
+
+
+def test_polling_error(azure, sleeps):
+    async def run():
+        client, requests = mock_client([
+            httpx.Response(202, headers={"Operation-Location": URL_OPERATION}),
+            httpx.Response(404, json={"error": {"message": "Operation expired"}}),
+        ])
+        async with client:
+            await azure.image_to_box_texts_async(url="https://img.test/deck.jpg", client=client)
+
+    with pytest.raises(Exception, match="Operation expired"):
+        asyncio.run(run())
+
+
+def test_exactly_one_source(azure):
+    with pytest.raises(TypeError):
+        asyncio.run(azure.image_to_box_texts_async())
+    with pytest.raises(TypeError):
+        asyncio.run(azure.image_to_box_texts_async(url="https://img.test/deck.jpg", path="deck.jpg"))
+
+
+def test_sync_calls_from_threads(azure, monkeypatch):
+    monkeypatch.setattr(azure, "_new_client",
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handle_analysis)))
+    barrier = threading.Barrier(4)  # makes each call run in its own thread
+
+    def call(_):
+        barrier.wait()
+        return azure.image_to_box_texts(url="https://img.test/deck.jpg")
+
+    with azure:
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(call, range(4)))
+        assert len(azure._sync_clients) == 4  # one loop and client per thread
+    assert all(len(box_texts) == 0 for box_texts in results)
+    assert azure._sync_clients == []
+
+
+def test_rate_limiter():
+    async def run():
+        limiter = RateLimiter(rps=20)
+        loop = asyncio.get_running_loop()
+        times = []
+
+        async def call():
+            await limiter.wait()
+            times.append(loop.time())
+
+        await asyncio.gather(*[call() for _ in range(4)])
+        return times
+
+    times = sorted(asyncio.run(run()))
+    for t1, t2 in zip(times, times[1:]):
+        assert t2 - t1 >= 0.05 - 0.01
+
+
+def test_batch_rate_across_calls(env):
+    azure = Azure(poll_delay=0, rps=20)
+    times = []
+
+    def handler(request):
+        if request.method == "POST":
+            times.append(time.monotonic())
+        return handle_analysis(request)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            for _ in range(2):
+                results = await azure.batch_image_to_box_texts_async(["https://img.test/deck.jpg"] * 2, client=client)
+                assert len(results) == 2
+
+    asyncio.run(run())
+    assert len(times) == 4
+    for t1, t2 in zip(times, times[1:]):
+        assert t2 - t1 >= 0.05 - 0.01
+
+
+def analyze_data(azure, data, lines=()):
+    """Box texts of the image `data`, found by a mocked Azure, and the body it received"""
+    async def run():
+        client, requests = mock_client([
+            httpx.Response(202, headers={"Operation-Location": URL_OPERATION}),
+            httpx.Response(200, json={"status": "succeeded",
+                                      "analyzeResult": {"readResults": [{"lines": list(lines)}]}}),
+        ])
+        async with client:
+            box_texts = await azure.image_to_box_texts_async(data=data, client=client)
+        return box_texts, requests[0].content
+    return asyncio.run(run())
+
+
+def image_bytes(width, height, fmt="PNG"):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def test_downscale(azure, sleeps):
+    data = image_bytes(4000, 1000)
+    box_texts, sent = analyze_data(azure, data, [{"boundingBox": [10, 20, 30, 20, 30, 40, 10, 40], "text": "Sol Ring"}])
+    with Image.open(BytesIO(sent)) as img:
+        assert img.format == "JPEG"
+        assert img.size == (2000, 500)
+    assert [(b.box, b.text) for b in box_texts] == [([20, 40, 60, 40, 60, 80, 20, 80], "Sol Ring")]
+
+
+@pytest.mark.parametrize("data", [image_bytes(2000, 1500), b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"])
+def test_sent_unchanged(azure, sleeps, caplog, data):
+    box_texts, sent = analyze_data(azure, data, [{"boundingBox": [10, 20, 30, 20, 30, 40, 10, 40], "text": "Sol Ring"}])
+    assert sent == data
+    assert box_texts[0].box == [10, 20, 30, 20, 30, 40, 10, 40]
+    assert not [record for record in caplog.records if record.levelno >= logging.WARNING]
+
+
+def test_streamed_upload(azure, sleeps, tmp_path):
+    path = tmp_path / "deck.pdf"
+    data = b"%PDF-1.4\n" + bytes(range(256)) * 1000  # several chunks, not decoded by PIL
+    path.write_bytes(data)
+
+    async def run():
+        client, requests = mock_client([
+            httpx.Response(503),
+            httpx.Response(202, headers={"Operation-Location": URL_OPERATION}),
+            httpx.Response(200, json={"status": "succeeded", "analyzeResult": {"readResults": []}}),
+        ])
+        async with client:
+            await azure.image_to_box_texts_async(path=path, client=client)
+        return requests
+
+    posts = asyncio.run(run())[:2]
+    for request in posts:  # a new stream for the retry
+        assert request.headers["Content-Length"] == str(len(data))
+        assert "Transfer-Encoding" not in request.headers
+        assert request.content == data
+
+
+def cached_analyses(azure, sources, n_analyses):
+    """Box texts of each source (keyword arguments of image_to_box_texts_async), with `n_analyses` sent to Azure"""
+    line = {"boundingBox": [1, 2, 3, 4, 5, 6, 7, 8], "text": "Black Lotus"}
+    analysis = {"status": "succeeded", "analyzeResult": {"readResults": [{"lines": [line]}]}}
+    responses = [httpx.Response(202, headers={"Operation-Location": URL_OPERATION}), httpx.Response(200, json=analysis)]
+
+    async def run():
+        client, requests = mock_client(responses * n_analyses)
+        async with client:
+            results = [await azure.image_to_box_texts_async(client=client, **source) for source in sources]
+        assert len(requests) == 2 * n_analyses
+        return results
+    return asyncio.run(run())
+
+
+def test_cache_hit(env, sleeps):
+    azure = Azure(cache_size=2)
+    data = b"%PDF-1.4\n"
+    cached_analyses(azure, [{"url": "https://img.test/a.jpg"}, {"url": "https://img.test/a.jpg"},
+                            {"data": data}, {"data": data}], n_analyses=2)
+
+
+def test_cache_eviction(env, sleeps):
+    azure = Azure(cache_size=2)
+    urls = ["https://img.test/a.jpg", "https://img.test/b.jpg", "https://img.test/a.jpg",  # a is most recent
+            "https://img.test/c.jpg", "https://img.test/a.jpg",  # evicts b
+            "https://img.test/b.jpg"]
+    cached_analyses(azure, [{"url": url} for url in urls], n_analyses=4)
+
+
+def test_cache_copies(env, sleeps):
+    azure = Azure(cache_size=2)
+    url = "https://img.test/a.jpg"
+    box_texts, = cached_analyses(azure, [{"url": url}], n_analyses=1)
+    box_texts[0].box[0] = 100
+    box_texts[0].text = "Mox Jet"
+    box_texts.add([0] * 8, "Sol Ring")
+    box_texts, = cached_analyses(azure, [{"url": url}], n_analyses=0)
+    assert [(b.box, b.text) for b in box_texts] == [([1, 2, 3, 4, 5, 6, 7, 8], "Black Lotus")]
+    box_texts[0].box[0] = 100
+    box_texts, = cached_analyses(azure, [{"url": url}], n_analyses=0)
+    assert box_texts[0].box[0] == 1
+
+
+def test_parse_read_results_scale():
+    analysis = {"analyzeResult": {"readResults": [
+        {"lines": [
+            {"boundingBox": [10, 20, 30, 20, 30, 41, 10, 41], "text": "Mox Pearl"},
+            {"boundingBox": [0, 0, 1, 0, 1, 1, 0, 1]},  # no text
+        ]},
+        {"lines": [{"boundingBox": [1, 1, 2, 1, 2, 2, 1, 2], "text": "Sol Ring"}]},
+    ]}}
+    box_texts = _parse_read_results(analysis, scale=1.5)
+    assert [(b.box, b.text) for b in box_texts] == [
+        ([15, 30, 45, 30, 45, 62, 15, 62], "Mox Pearl"),
+        ([2, 2, 3, 2, 3, 3, 2, 3], "Sol Ring"),
+    ]
+    box_texts = _parse_read_results(analysis)
+    assert box_texts[0].box == [10, 20, 30, 20, 30, 41, 10, 41]
@@ -0,0 +1,27 @@
+import pytest
+
+from mtgscan.utils import is_file, is_url
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("https://xqimg.imedao.com/18b2a6cf9b7b81063fdb0127.jpg", True),
+    ("http://localhost/image.png", True),
+    ("s3://bucket/image.jpg", True),
+    ("data:image/jpeg;base64,/9j/4AAQ", True),
+    ("tests/samples/arena_RG/image.jpg", False),
+    ("/tmp/image.jpg", False),
+    ("C:\\images\\image.jpg", False),
+    ("/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAgGBgcGBQgH", False),
+    ("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJ", False),
+])
+def test_is_url(text, expected):
+    assert is_url(text) is expected
+
+
+def test_is_file(tmp_path):
+    f = tmp_path / "image.jpg"
+    f.write_bytes(b"")
+    assert is_file(f)
+    assert not is_file(tmp_path / "missing.jpg")
+    assert not is_file("A" * 5000)
+    assert not is_file("image\x00.jpg")